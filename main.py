@@ -1,19 +1,39 @@
 import os
+import re
 import time
 import json
+import hashlib
+import multiprocessing
+import queue
 import sqlite3
 import threading
-from collections import Counter
-from typing import Dict, List, Tuple, Any, Optional
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
+from io import BytesIO
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 import telebot
 import telebot.apihelper as apihelper
 from telebot import types
 from openpyxl import load_workbook
+
+try:
+    from python_calamine import CalamineWorkbook  # Rust-парсер, заметно быстрее openpyxl
+except ImportError:
+    CalamineWorkbook = None
+
+try:
+    import orjson  # Rust-JSON: в разы быстрее stdlib на наших словарях средних
+except ImportError:
+    orjson = None
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-from flask import Flask
+from flask import Flask, request as flask_request
 
 # ================== НАСТРОЙКИ ==================
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
@@ -25,28 +45,87 @@ if not BOT_TOKEN:
 ADMIN_CHAT_ID = int(os.environ.get("ADMIN_CHAT_ID", "0"))
 
 DEFAULT_TZ = "Europe/Berlin"
+
+# Валидное время напоминания; допускаем и "8:30", и "08:30"
+TIME_RE = re.compile(r"^([01]?\d|2[0-3]):([0-5]?\d)$")
 SEP = "||"
 HISTORY_LIMIT = 60
 
 PORT_DEFAULT = "10000"
 DB_PATH = os.environ.get("DB_PATH", "bot.db")
 
+# Если задан публичный URL (на Render это RENDER_EXTERNAL_URL) — работаем через
+# webhook вместо long-polling: Telegram сам пушит апдейты в Flask.
+PUBLIC_URL = os.environ.get("PUBLIC_URL") or os.environ.get("RENDER_EXTERNAL_URL")
+
 # Telegram timeouts (меньше отвалов)
 apihelper.CONNECT_TIMEOUT = 10
 apihelper.READ_TIMEOUT = 30
 
+# Один Session с увеличенным пулом keep-alive соединений на все вызовы API:
+# воркеры не исчерпывают дефолтный пул requests и не платят TLS-handshake
+# за каждую отправку.
+_tg_session = requests.Session()
+_tg_session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=50))
+apihelper.CUSTOM_REQUEST_SENDER = _tg_session.request
+
 bot = telebot.TeleBot(BOT_TOKEN, threaded=True, num_threads=4)
 
 # ================== safe_send ==================
+# Telegram лимитирует ~30 сообщений/с на бота и ~1/с в один чат. Все отправки
+# идут через одну очередь с токен-бакетом: всплеск (фан-аут напоминаний в
+# 08:00) не ловит 429, а хэндлеры не спят в ретраях на своих потоках.
+SEND_GLOBAL_INTERVAL = 1 / 30
+SEND_CHAT_INTERVAL = 1.0
+
+send_queue: "queue.Queue[Tuple[int, str, Any, int]]" = queue.Queue()
+_last_send_at: Dict[int, float] = {}
+
+def _send_worker():
+    last_global = 0.0
+    while True:
+        chat_id, text, reply_markup, tries = send_queue.get()
+        for i in range(tries):
+            now = time.monotonic()
+            wait = max(
+                last_global + SEND_GLOBAL_INTERVAL - now,
+                _last_send_at.get(chat_id, 0.0) + SEND_CHAT_INTERVAL - now,
+                0.0,
+            )
+            if wait:
+                time.sleep(wait)
+            last_global = time.monotonic()
+            _last_send_at[chat_id] = last_global
+            try:
+                bot.send_message(chat_id, text, reply_markup=reply_markup)
+                break
+            except apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    # Telegram сообщает retry_after — тормозим весь воркер
+                    retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 5)
+                    time.sleep(retry_after)
+                else:
+                    break
+            except (requests.exceptions.RequestException, ConnectionError):
+                time.sleep(2 + i * 2)
+            except Exception:
+                time.sleep(1)
+        send_queue.task_done()
+
 def safe_send(chat_id: int, text: str, reply_markup=None, tries: int = 3):
-    for i in range(tries):
-        try:
-            return bot.send_message(chat_id, text, reply_markup=reply_markup)
-        except (requests.exceptions.RequestException, ConnectionError):
-            time.sleep(2 + i * 2)
-        except Exception:
-            time.sleep(1)
-    return None
+    send_queue.put((chat_id, text, reply_markup, tries))
+
+# Telegram не принимает сообщения длиннее 4096 символов — режем по переносам
+def chunk_text(text: str, limit: int = 4000) -> List[str]:
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    chunks.append(text)
+    return chunks
 
 # ================== Flask (порт-заглушка для Render Web Service) ==================
 app = Flask(__name__)
@@ -55,23 +134,90 @@ app = Flask(__name__)
 def home():
     return "OK", 200
 
+@app.post(f"/{BOT_TOKEN}")
+def telegram_webhook():
+    update = types.Update.de_json(flask_request.get_json(force=True))
+    bot.process_new_updates([update])
+    return "", 200
+
 # ================== Scheduler ==================
 scheduler = BackgroundScheduler(timezone=DEFAULT_TZ)
-scheduler.start()
-scheduled_jobs: Dict[int, str] = {}
+
+# ================== JSON-хелперы ==================
+# Средние/снапшоты (де)сериализуются на каждом аплодосе и многих колбэках.
+def json_dumps(obj) -> str:
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False)
+
+def json_loads(s):
+    return orjson.loads(s) if orjson else json.loads(s)
 
 # ================== SQLite ==================
-db_lock = threading.Lock()
+db_lock = threading.RLock()
 
 def db_conn() -> sqlite3.Connection:
-    con = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # isolation_level=None: транзакциями управляем сами (BEGIN IMMEDIATE ниже)
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                          cached_statements=256)
     con.row_factory = sqlite3.Row
     # важная штука для каскадного удаления
     con.execute("PRAGMA foreign_keys = ON;")
+    # WAL: читатели не блокируются писателем, меньше fsync на коммит
+    con.execute("PRAGMA journal_mode = WAL;")
+    con.execute("PRAGMA synchronous = NORMAL;")
+    # не падать сразу на SQLITE_BUSY, а подождать писателя
+    con.execute("PRAGMA busy_timeout = 30000;")
+    con.execute("PRAGMA temp_store = MEMORY;")
+    # ~20 МБ страничного кэша и mmap на чтение — база целиком живёт в памяти
+    con.execute("PRAGMA cache_size = -20000;")
+    con.execute("PRAGMA mmap_size = 134217728;")
     return con
 
 CON = db_conn()
 
+# Пока открыта write_transaction, промежуточные db_commit() — no-op:
+# весь пакет записей уезжает одним COMMIT (один fsync вместо пяти).
+_in_txn = False
+
+def db_commit():
+    if not _in_txn:
+        CON.commit()
+
+@contextmanager
+def write_transaction():
+    global _in_txn
+    with db_lock:
+        CON.execute("BEGIN IMMEDIATE")
+        _in_txn = True
+        try:
+            yield
+        except Exception:
+            CON.execute("ROLLBACK")
+            raise
+        else:
+            CON.execute("COMMIT")
+        finally:
+            _in_txn = False
+
+# Читающие хэндлеры не обязаны стоять в очереди за писателем: в WAL чтение
+# конкурентно, поэтому каждый поток telebot держит свою read-only connection
+# (mode=ro), а CON + db_lock остаются единственным путём для записи.
+_read_local = threading.local()
+
+def read_conn() -> sqlite3.Connection:
+    con = getattr(_read_local, "con", None)
+    if con is None:
+        con = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False,
+                              cached_statements=256)
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA busy_timeout = 30000;")
+        con.execute("PRAGMA temp_store = MEMORY;")
+        con.execute("PRAGMA cache_size = -20000;")
+        con.execute("PRAGMA mmap_size = 134217728;")
+        _read_local.con = con
+    return con
+
 def init_db():
     with db_lock:
         cur = CON.cursor()
@@ -82,9 +228,22 @@ def init_db():
             reminder_time TEXT DEFAULT NULL,
             awaiting_time INTEGER NOT NULL DEFAULT 0,
             last_overall REAL DEFAULT NULL,
-            last_averages_json TEXT DEFAULT NULL
+            last_averages_json TEXT DEFAULT NULL,
+            last_file_hash TEXT DEFAULT NULL,
+            last_best TEXT DEFAULT NULL,
+            last_worst TEXT DEFAULT NULL
         )
         """)
+        # миграции для баз, созданных по старой схеме
+        for ddl in (
+            "ALTER TABLE users ADD COLUMN last_file_hash TEXT DEFAULT NULL",
+            "ALTER TABLE users ADD COLUMN last_best TEXT DEFAULT NULL",
+            "ALTER TABLE users ADD COLUMN last_worst TEXT DEFAULT NULL",
+        ):
+            try:
+                cur.execute(ddl)
+            except sqlite3.OperationalError:
+                pass
         cur.execute("""
         CREATE TABLE IF NOT EXISTS grade_counter (
             chat_id INTEGER NOT NULL,
@@ -114,67 +273,141 @@ def init_db():
             FOREIGN KEY (snapshot_id) REFERENCES snapshots(id) ON DELETE CASCADE
         )
         """)
-        CON.commit()
+        # индексы под горячие выборки: история/последний snapshot по чату,
+        # undo-выборка по snapshot_id, счётчик по чату
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_chat_id ON snapshots(chat_id, id DESC)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_counter_snapshots_sid ON counter_snapshots(snapshot_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_grade_counter_chat ON grade_counter(chat_id)")
+        db_commit()
+
+# Горячие запросы — модульные константы: один и тот же объект строки даёт
+# стабильный ключ в statement cache соединения, SQL не перекомпилируется.
+SQL_ENSURE_USER = "INSERT OR IGNORE INTO users(chat_id) VALUES (?)"
+# DO UPDATE вместо DO NOTHING: иначе RETURNING молчит для существующей строки
+SQL_ENSURE_AND_GET = (
+    "INSERT INTO users(chat_id) VALUES (?) "
+    "ON CONFLICT(chat_id) DO UPDATE SET chat_id=excluded.chat_id "
+    "RETURNING *"
+)
+SQL_GET_COUNTER = "SELECT k, cnt FROM grade_counter WHERE chat_id=?"
+SQL_UPSERT_COUNTER_HEAD = "INSERT INTO grade_counter(chat_id, k, cnt) VALUES "
+SQL_UPSERT_COUNTER_TAIL = " ON CONFLICT(chat_id, k) DO UPDATE SET cnt=excluded.cnt"
+SQL_ADD_SNAPSHOT = "INSERT INTO snapshots(chat_id, ts, overall, averages_json) VALUES (?, ?, ?, ?)"
+SQL_LATEST_SNAPSHOT_ID = "SELECT id FROM snapshots WHERE chat_id=? ORDER BY id DESC LIMIT 1"
+SQL_GET_SNAPSHOT = "SELECT ts, overall, averages_json FROM snapshots WHERE id=?"
+SQL_COUNTER_BY_SNAPSHOT = "SELECT k, cnt FROM counter_snapshots WHERE snapshot_id=?"
+SQL_SAVE_COUNTER_SNAPSHOT_HEAD = "INSERT OR REPLACE INTO counter_snapshots(snapshot_id, k, cnt) VALUES "
+SQL_HISTORY_OVERALL = (
+    "SELECT ts, overall FROM snapshots "
+    "WHERE chat_id=? ORDER BY id DESC LIMIT ?"
+)
+SQL_HISTORY_SUBJECT = (
+    "SELECT ts, json_extract(averages_json, ?) AS av FROM snapshots "
+    "WHERE chat_id=? AND json_extract(averages_json, ?) IS NOT NULL "
+    "ORDER BY id DESC LIMIT ?"
+)
+SQL_HISTORY_JSON = (
+    "SELECT ts, averages_json FROM snapshots "
+    "WHERE chat_id=? ORDER BY id DESC LIMIT ?"
+)
+
+# Многострочный VALUES вместо executemany: один шаг statement'а на пачку
+# строк. 100 строк по 3 параметра — с большим запасом до лимита SQLite
+# на число переменных в запросе.
+def bulk_execute(cur: sqlite3.Cursor, head: str, rows: List[tuple], tail: str = "", chunk: int = 100):
+    if not rows:
+        return
+    one = "(" + ",".join("?" * len(rows[0])) + ")"
+    for i in range(0, len(rows), chunk):
+        part = rows[i:i + chunk]
+        cur.execute(head + ",".join([one] * len(part)) + tail,
+                    [v for row in part for v in row])
+
+# Чаты, про которые точно известно, что строка в users есть: повторные
+# ensure_user не трогают БД (иначе каждый /start — это INSERT + commit).
+_known_users: set = set()
 
 def ensure_user(chat_id: int):
+    if chat_id in _known_users:
+        return
     with db_lock:
         cur = CON.cursor()
-        cur.execute("INSERT OR IGNORE INTO users(chat_id) VALUES (?)", (chat_id,))
-        CON.commit()
-
-def get_user_row(chat_id: int) -> sqlite3.Row:
-    ensure_user(chat_id)
+        cur.execute(SQL_ENSURE_USER, (chat_id,))
+        db_commit()
+    _known_users.add(chat_id)
+
+# Кэш строк users: колбэки дёргают get_user_row по нескольку раз на нажатие,
+# а строка меняется только через set_user_fields (там и инвалидация).
+_user_cache: Dict[int, Dict[str, Any]] = {}
+_user_cache_lock = threading.RLock()
+
+def get_user_row(chat_id: int) -> Dict[str, Any]:
+    with _user_cache_lock:
+        row = _user_cache.get(chat_id)
+    if row is not None:
+        return row
+    # ensure + SELECT одним запросом (SQLite 3.35+): нет отдельного
+    # INSERT OR IGNORE с его коммитом перед каждым чтением
     with db_lock:
         cur = CON.cursor()
-        cur.execute("SELECT * FROM users WHERE chat_id=?", (chat_id,))
-        return cur.fetchone()
+        cur.execute(SQL_ENSURE_AND_GET, (chat_id,))
+        row = dict(cur.fetchone())
+        db_commit()
+    _known_users.add(chat_id)
+    with _user_cache_lock:
+        _user_cache[chat_id] = row
+    return row
 
 def set_user_fields(chat_id: int, **fields):
-    ensure_user(chat_id)
     if not fields:
         return
-    cols, vals = [], []
-    for k, v in fields.items():
-        cols.append(f"{k}=?")
-        vals.append(v)
-    vals.append(chat_id)
-    q = "UPDATE users SET " + ", ".join(cols) + " WHERE chat_id=?"
+    # один UPSERT вместо ensure_user + UPDATE: строка создаётся по пути,
+    # коммит один
+    cols = list(fields)
+    q = (
+        "INSERT INTO users(chat_id, " + ", ".join(cols) + ") "
+        "VALUES (" + ", ".join("?" * (len(cols) + 1)) + ") "
+        "ON CONFLICT(chat_id) DO UPDATE SET "
+        + ", ".join(f"{c}=excluded.{c}" for c in cols)
+    )
     with db_lock:
         cur = CON.cursor()
-        cur.execute(q, tuple(vals))
-        CON.commit()
+        cur.execute(q, (chat_id, *fields.values()))
+        db_commit()
+    _known_users.add(chat_id)
+    with _user_cache_lock:
+        _user_cache.pop(chat_id, None)
 
 def get_counter(chat_id: int) -> Counter:
     ensure_user(chat_id)
-    with db_lock:
-        cur = CON.cursor()
-        cur.execute("SELECT k, cnt FROM grade_counter WHERE chat_id=?", (chat_id,))
-        rows = cur.fetchall()
-    c = Counter()
-    for r in rows:
-        c[r["k"]] = int(r["cnt"])
-    return c
+    cur = read_conn().execute(SQL_GET_COUNTER, (chat_id,))
+    return Counter({r["k"]: int(r["cnt"]) for r in cur.fetchall()})
 
-def set_counter(chat_id: int, c: Counter):
+def set_counter(chat_id: int, c: Counter, old: Optional[Counter] = None):
     ensure_user(chat_id)
+    # пишем только разницу: апсертим изменившиеся ключи, удаляем исчезнувшие —
+    # вместо полного DELETE + переписывания всей партиции на каждый аплоад
+    if old is None:
+        old = get_counter(chat_id)
+    to_upsert = [(chat_id, k, int(v)) for k, v in c.items() if old.get(k) != v]
+    to_delete = list(old.keys() - c.keys())
+    if not to_upsert and not to_delete:
+        return
     with db_lock:
         cur = CON.cursor()
-        cur.execute("DELETE FROM grade_counter WHERE chat_id=?", (chat_id,))
-        cur.executemany(
-            "INSERT INTO grade_counter(chat_id, k, cnt) VALUES (?, ?, ?)",
-            [(chat_id, k, int(v)) for k, v in c.items()]
-        )
-        CON.commit()
-
-def add_snapshot(chat_id: int, ts: str, overall: float, averages: Dict[str, float]) -> int:
+        bulk_execute(cur, SQL_UPSERT_COUNTER_HEAD, to_upsert, SQL_UPSERT_COUNTER_TAIL)
+        if to_delete:
+            ph = ",".join("?" * len(to_delete))
+            cur.execute(f"DELETE FROM grade_counter WHERE chat_id=? AND k IN ({ph})", (chat_id, *to_delete))
+        db_commit()
+
+def add_snapshot(chat_id: int, ts: str, overall: float, averages_json: str) -> int:
+    # принимает уже сериализованные средние: вызывающий дампит их один раз
+    # и для snapshots, и для users.last_averages_json
     ensure_user(chat_id)
-    averages_json = json.dumps(averages, ensure_ascii=False)
     with db_lock:
         cur = CON.cursor()
-        cur.execute(
-            "INSERT INTO snapshots(chat_id, ts, overall, averages_json) VALUES (?, ?, ?, ?)",
-            (chat_id, ts, float(overall), averages_json)
-        )
+        cur.execute(SQL_ADD_SNAPSHOT, (chat_id, ts, float(overall), averages_json))
         snapshot_id = int(cur.lastrowid)
 
         # ограничим историю до HISTORY_LIMIT
@@ -186,102 +419,109 @@ def add_snapshot(chat_id: int, ts: str, overall: float, averages: Dict[str, floa
               )
         """, (chat_id, chat_id, HISTORY_LIMIT))
 
-        CON.commit()
+        db_commit()
     return snapshot_id
 
 def save_counter_snapshot(snapshot_id: int, c: Counter):
     with db_lock:
         cur = CON.cursor()
-        cur.executemany(
-            "INSERT OR REPLACE INTO counter_snapshots(snapshot_id, k, cnt) VALUES (?, ?, ?)",
-            [(snapshot_id, k, int(v)) for k, v in c.items()]
-        )
-        CON.commit()
+        bulk_execute(cur, SQL_SAVE_COUNTER_SNAPSHOT_HEAD,
+                     [(snapshot_id, k, int(v)) for k, v in c.items()])
+        db_commit()
 
 def get_latest_snapshot_id(chat_id: int) -> Optional[int]:
-    with db_lock:
-        cur = CON.cursor()
-        cur.execute("SELECT id FROM snapshots WHERE chat_id=? ORDER BY id DESC LIMIT 1", (chat_id,))
-        row = cur.fetchone()
+    cur = read_conn().execute(SQL_LATEST_SNAPSHOT_ID, (chat_id,))
+    row = cur.fetchone()
     return int(row["id"]) if row else None
 
 def get_snapshot_data(snapshot_id: int) -> Optional[Dict[str, Any]]:
-    with db_lock:
-        cur = CON.cursor()
-        cur.execute("SELECT ts, overall, averages_json FROM snapshots WHERE id=?", (snapshot_id,))
-        row = cur.fetchone()
+    cur = read_conn().execute(SQL_GET_SNAPSHOT, (snapshot_id,))
+    row = cur.fetchone()
     if not row:
         return None
     return {
         "ts": row["ts"],
         "overall": float(row["overall"]),
-        "averages": json.loads(row["averages_json"]),
+        "averages": json_loads(row["averages_json"]),
     }
 
 def get_counter_by_snapshot(snapshot_id: int) -> Counter:
-    with db_lock:
-        cur = CON.cursor()
-        cur.execute("SELECT k, cnt FROM counter_snapshots WHERE snapshot_id=?", (snapshot_id,))
-        rows = cur.fetchall()
-    c = Counter()
-    for r in rows:
-        c[r["k"]] = int(r["cnt"])
-    return c
-
-def get_history(chat_id: int, limit: int = 10) -> List[Dict[str, Any]]:
-    ensure_user(chat_id)
-    with db_lock:
-        cur = CON.cursor()
-        cur.execute("""
-            SELECT ts, overall, averages_json
-            FROM snapshots
-            WHERE chat_id=?
-            ORDER BY id DESC
-            LIMIT ?
-        """, (chat_id, limit))
-        rows = cur.fetchall()
-    out = []
-    for r in reversed(rows):
-        out.append({
-            "ts": r["ts"],
-            "overall": float(r["overall"]),
-            "averages": json.loads(r["averages_json"])
-        })
-    return out
-
-def get_last_averages(chat_id: int) -> Dict[str, float]:
-    row = get_user_row(chat_id)
+    cur = read_conn().execute(SQL_COUNTER_BY_SNAPSHOT, (snapshot_id,))
+    return Counter({r["k"]: int(r["cnt"]) for r in cur.fetchall()})
+
+# Специализированные выборки для «Динамики»: общий график не трогает JSON
+# вообще, а по предмету значение достаёт json_extract на стороне SQLite —
+# вместо десериализации десяти полных словарей ради одного ключа.
+# Готовые серии кэшируются на чат (ключ — (предмет|None, limit)); история
+# меняется только при загрузке/откате, там кэш и сбрасывается.
+_history_cache: Dict[int, Dict[Tuple[Optional[str], int], List[Tuple[str, float]]]] = {}
+_history_cache_lock = threading.RLock()
+
+def invalidate_history_cache(chat_id: int):
+    with _history_cache_lock:
+        _history_cache.pop(chat_id, None)
+
+def get_history_overall(chat_id: int, limit: int = 10) -> List[Tuple[str, float]]:
+    key = (None, limit)
+    with _history_cache_lock:
+        per_chat = _history_cache.get(chat_id)
+        if per_chat is not None and key in per_chat:
+            return per_chat[key]
+    cur = read_conn().execute(SQL_HISTORY_OVERALL, (chat_id, limit))
+    series = [(r["ts"], float(r["overall"])) for r in reversed(cur.fetchall())]
+    with _history_cache_lock:
+        _history_cache.setdefault(chat_id, {})[key] = series
+    return series
+
+def get_history_subject(chat_id: int, subject: str, limit: int = 10) -> List[Tuple[str, float]]:
+    key = (subject, limit)
+    with _history_cache_lock:
+        per_chat = _history_cache.get(chat_id)
+        if per_chat is not None and key in per_chat:
+            return per_chat[key]
+    if '"' in subject or "\\" in subject:
+        # кавычку/бэкслеш в ключе JSON-путь SQLite не принимает ни в каком
+        # экранировании — для таких предметов достаём словарь по-старому
+        cur = read_conn().execute(SQL_HISTORY_JSON, (chat_id, limit))
+        series = [
+            (r["ts"], float(av))
+            for r in reversed(cur.fetchall())
+            if (av := json_loads(r["averages_json"]).get(subject)) is not None
+        ]
+    else:
+        path = f'$."{subject}"'
+        cur = read_conn().execute(SQL_HISTORY_SUBJECT, (path, chat_id, path, limit))
+        series = [(r["ts"], float(r["av"])) for r in reversed(cur.fetchall())]
+    with _history_cache_lock:
+        _history_cache.setdefault(chat_id, {})[key] = series
+    return series
+
+def averages_from_row(row: Dict[str, Any]) -> Dict[str, float]:
     js = row["last_averages_json"]
     if not js:
         return {}
     try:
-        return json.loads(js)
+        return json_loads(js)
     except Exception:
         return {}
 
-def get_last_overall(chat_id: int) -> Optional[float]:
-    row = get_user_row(chat_id)
-    v = row["last_overall"]
-    return None if v is None else float(v)
-
 init_db()
 
 # ================== Export (все пользователи) ==================
 def dump_all_data_to_dict() -> Dict[str, Any]:
-    with db_lock:
-        cur = CON.cursor()
+    cur = read_conn().cursor()
 
-        cur.execute("SELECT * FROM users")
-        users = [dict(r) for r in cur.fetchall()]
+    cur.execute("SELECT * FROM users")
+    users = [dict(r) for r in cur.fetchall()]
 
-        cur.execute("SELECT * FROM grade_counter")
-        grade_counter = [dict(r) for r in cur.fetchall()]
+    cur.execute("SELECT * FROM grade_counter")
+    grade_counter = [dict(r) for r in cur.fetchall()]
 
-        cur.execute("SELECT * FROM snapshots")
-        snapshots = [dict(r) for r in cur.fetchall()]
+    cur.execute("SELECT * FROM snapshots")
+    snapshots = [dict(r) for r in cur.fetchall()]
 
-        cur.execute("SELECT * FROM counter_snapshots")
-        counter_snapshots = [dict(r) for r in cur.fetchall()]
+    cur.execute("SELECT * FROM counter_snapshots")
+    counter_snapshots = [dict(r) for r in cur.fetchall()]
 
     return {
         "exported_at": time.strftime("%Y-%m-%d %H:%M:%S"),
@@ -302,17 +542,9 @@ def export_all(message):
 
     payload = dump_all_data_to_dict()
     fname = f"backup_all_{time.strftime('%Y%m%d_%H%M%S')}.json"
-    with open(fname, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
-
-    try:
-        with open(fname, "rb") as f:
-            bot.send_document(chat_id, f, caption="✅ Экспорт всех данных (JSON).")
-    finally:
-        try:
-            os.remove(fname)
-        except Exception:
-            pass
+    # дамп уходит прямо из памяти — без временного файла на эфемерном диске
+    buf = BytesIO(json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8"))
+    bot.send_document(chat_id, buf, visible_file_name=fname, caption="✅ Экспорт всех данных (JSON).")
 
 @bot.message_handler(commands=["export_db"])
 def export_db(message):
@@ -327,51 +559,90 @@ def export_db(message):
         safe_send(chat_id, "Не получилось отправить файл базы. Возможно его нет или нет доступа.")
 
 # ================== Excel -> оценки ==================
-def parse_excel_grades(file_path: str) -> List[Tuple[str, int]]:
-    wb = load_workbook(file_path)
-    sheet = wb.active
-    items: List[Tuple[str, int]] = []
+def _rows_calamine(src: BinaryIO):
+    wb = CalamineWorkbook.from_filelike(src)
+    return wb.get_sheet_by_index(0).to_python()
+
+def _rows_openpyxl(src: BinaryIO):
+    # read_only: стримим строки из XML вместо загрузки всей книги в память
+    wb = load_workbook(src, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = wb.active
+        # некоторые генераторы xlsx пишут битый dimension (A1:A1) —
+        # в read_only режиме это срезало бы весь лист
+        if sheet.calculate_dimension() == "A1:A1":
+            sheet.reset_dimensions()
+        yield from sheet.iter_rows(values_only=True)
+    finally:
+        wb.close()
 
-    for row in sheet.iter_rows(values_only=True):
-        subject = row[0]
+def parse_excel_grades(src: BinaryIO) -> List[Tuple[str, int]]:
+    rows = _rows_calamine(src) if CalamineWorkbook else _rows_openpyxl(src)
+    items: List[Tuple[str, int]] = []
+    for row in rows:
+        subject = row[0] if row else None
         if not subject or not isinstance(subject, str):
             continue
         subject = subject.strip()
-        for cell in row[1:]:
-            if isinstance(cell, (int, float)):
-                items.append((subject, int(cell)))
+        # type() is вместо isinstance: числовые ячейки — всегда ровно int/float
+        items.extend(
+            (subject, int(cell))
+            for cell in row[1:]
+            if type(cell) is int or type(cell) is float
+        )
     return items
 
-def analyze_items(items: List[Tuple[str, int]]) -> Optional[Dict[str, Any]]:
+def analyze_and_count(items: List[Tuple[str, int]]) -> Tuple[Optional[Dict[str, Any]], Counter]:
+    # один проход по items: копим (сумма, количество) для средних и сразу
+    # же счётчик «предмет||оценка» — не гоняем список дважды
+    c: Counter = Counter()
     if not items:
-        return None
-    by_subject: Dict[str, List[int]] = {}
+        return None, c
+    acc: Dict[str, List[int]] = defaultdict(lambda: [0, 0])
     for subj, grade in items:
-        by_subject.setdefault(subj, []).append(grade)
-    averages = {s: sum(vals) / len(vals) for s, vals in by_subject.items()}
+        pair = acc[subj]
+        pair[0] += grade
+        pair[1] += 1
+        c[f"{subj}{SEP}{grade}"] += 1
+    averages = {s: total / cnt for s, (total, cnt) in acc.items()}
     overall = sum(averages.values()) / len(averages)
     best = max(averages, key=averages.get)
     worst = min(averages, key=averages.get)
-    return {"overall": overall, "best": best, "worst": worst, "averages": averages}
+    return {"overall": overall, "best": best, "worst": worst, "averages": averages}, c
 
-def make_counter(items: List[Tuple[str, int]]) -> Counter:
-    c = Counter()
-    for subj, grade in items:
-        c[f"{subj}{SEP}{grade}"] += 1
-    return c
+# Повторная загрузка того же файла (типовой сценарий «проверить новые оценки»)
+# не должна парсить XML заново: кэшируем результат по хэшу содержимого.
+PARSE_CACHE_LIMIT = 32
+_parse_cache: "OrderedDict[str, List[Tuple[str, int]]]" = OrderedDict()
+
+def file_cache_key(raw: bytes) -> str:
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+# Парсинг XLSX — чистый CPU (XML): выносим его в отдельные процессы, чтобы
+# большой файл не держал GIL и не стопорил колбэки на воркерах telebot.
+# Явный fork: spawn/forkserver переисполняли бы модуль в воркере — со всеми
+# его side-эффектами (бот, планировщик, webhook/поллинг, даже с guard'ом
+# внизу файла остаётся init_db и т.п.). Форкать безопасно только пока в
+# процессе нет потоков, поэтому воркеры поднимаются прямо здесь, при
+# импорте: все нужные им функции выше уже определены, а наши потоки
+# (отправщик, планировщик, поллинг) стартуют позже, в main(). Пул потоков
+# telebot существует с конструктора, но на момент импорта простаивает.
+PARSE_POOL = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("fork"))
+
+def parse_excel_bytes(raw: bytes) -> List[Tuple[str, int]]:
+    return parse_excel_grades(BytesIO(raw))
+
+# прогрев: no-op задача форкает обоих воркеров прямо сейчас
+PARSE_POOL.submit(os.getpid).result()
 
 def parse_counter_key(key: str) -> Tuple[str, int]:
     subj, grade = key.split(SEP, 1)
     return subj, int(grade)
 
 def diff_new_grades(old: Counter, new: Counter) -> List[Tuple[str, int, int]]:
-    added = []
-    for key, new_count in new.items():
-        old_count = old.get(key, 0)
-        if new_count > old_count:
-            subj, grade = parse_counter_key(key)
-            added.append((subj, grade, new_count - old_count))
-    added.sort(key=lambda x: (x[0], x[1]))
+    # Counter-вычитание (реализовано на C) оставляет только положительные дельты
+    added = [(*parse_counter_key(key), cnt) for key, cnt in (new - old).items()]
+    added.sort(key=itemgetter(0, 1))
     return added
 
 # ================== UI ==================
@@ -403,9 +674,29 @@ def reminders_kb(enabled: bool) -> types.InlineKeyboardMarkup:
     kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="back"))
     return kb
 
-def subjects_kb(subjects: List[str], page: int = 0, per_page: int = 8) -> types.InlineKeyboardMarkup:
+# Эти клавиатуры неизменяемы — собираем и сериализуем по одному разу при
+# старте: telebot принимает reply_markup готовой JSON-строкой и тогда не
+# кодирует разметку заново на каждую отправку
+MENU_KB = menu_kb().to_json()
+REM_KB_ON = reminders_kb(True).to_json()
+REM_KB_OFF = reminders_kb(False).to_json()
+
+# Отсортированный список предметов не меняется между загрузками файла —
+# кэшируем его на пользователя, чтобы не сортировать на каждом листании.
+_subjects_cache: Dict[int, Tuple[str, ...]] = {}
+
+def get_subjects_sorted(chat_id: int, averages: Dict[str, float]) -> Tuple[str, ...]:
+    cached = _subjects_cache.get(chat_id)
+    if cached is None:
+        cached = tuple(sorted(averages.keys()))
+        _subjects_cache[chat_id] = cached
+    return cached
+
+# клавиатура зависит только от (кортеж предметов, страница) — мемоизируем
+# готовую JSON-строку, как и статические клавиатуры выше
+@lru_cache(maxsize=256)
+def subjects_kb(subjects_sorted: Tuple[str, ...], page: int = 0, per_page: int = 8) -> str:
     kb = types.InlineKeyboardMarkup(row_width=2)
-    subjects_sorted = sorted(subjects)
     start = page * per_page
     chunk = subjects_sorted[start:start + per_page]
 
@@ -421,50 +712,45 @@ def subjects_kb(subjects: List[str], page: int = 0, per_page: int = 8) -> types.
         kb.row(*nav)
 
     kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="trend"))
-    return kb
+    return kb.to_json()
 
 # ================== Напоминания ==================
 def reminder_job(chat_id: int):
     safe_send(chat_id, "⏰ Пора обновить оценки: отправь свежий Excel-файл (.xlsx).")
 
-def schedule_user_reminder(chat_id: int, hhmm: str):
-    old_job_id = scheduled_jobs.get(chat_id)
-    if old_job_id:
-        try:
-            scheduler.remove_job(old_job_id)
-        except Exception:
-            pass
+# какое время уже стоит в планировщике — чтобы не пересоздавать job впустую
+_reminder_times: Dict[int, str] = {}
 
+def schedule_user_reminder(chat_id: int, hhmm: str):
+    if _reminder_times.get(chat_id) == hhmm:
+        return
     hour, minute = hhmm.split(":")
-    job_id = f"rem_{chat_id}"
 
     scheduler.add_job(
         reminder_job,
         trigger=CronTrigger(hour=int(hour), minute=int(minute)),
         args=[chat_id],
-        id=job_id,
+        id=f"rem_{chat_id}",
         replace_existing=True,
+        # после даунтайма шлём максимум одно напоминание, а не пачку пропущенных
+        coalesce=True,
+        misfire_grace_time=3600,
     )
-    scheduled_jobs[chat_id] = job_id
+    _reminder_times[chat_id] = hhmm
 
 def unschedule_user_reminder(chat_id: int):
-    job_id = scheduled_jobs.get(chat_id)
-    if job_id:
-        try:
-            scheduler.remove_job(job_id)
-        except Exception:
-            pass
-        scheduled_jobs.pop(chat_id, None)
+    _reminder_times.pop(chat_id, None)
+    try:
+        scheduler.remove_job(f"rem_{chat_id}")
+    except Exception:
+        pass
 
 def restore_jobs_from_db():
-    with db_lock:
-        cur = CON.cursor()
-        cur.execute("SELECT chat_id, reminder_time FROM users WHERE reminder_enabled=1 AND reminder_time IS NOT NULL")
-        rows = cur.fetchall()
+    cur = read_conn().execute("SELECT chat_id, reminder_time FROM users WHERE reminder_enabled=1 AND reminder_time IS NOT NULL")
+    rows = cur.fetchall()
     for r in rows:
         schedule_user_reminder(int(r["chat_id"]), r["reminder_time"])
 
-restore_jobs_from_db()
 
 # ================== Команды ==================
 @bot.message_handler(commands=["start"])
@@ -475,7 +761,7 @@ def start_cmd(message):
         "Привет! 👋\n"
         "Отправь Excel (.xlsx) с оценками — я сделаю анализ.\n"
         "Данные хранятся в SQLite, есть откат последней загрузки и экспорт.",
-        reply_markup=menu_kb()
+        reply_markup=MENU_KB
     )
 
 # ================== Приём файла ==================
@@ -483,319 +769,387 @@ def start_cmd(message):
 def on_document(message):
     file_name = message.document.file_name or ""
     if not file_name.lower().endswith(".xlsx"):
-        safe_send(message.chat.id, "Нужен файл формата .xlsx 🙂", reply_markup=menu_kb())
+        safe_send(message.chat.id, "Нужен файл формата .xlsx 🙂", reply_markup=MENU_KB)
         return
 
-    ensure_user(message.chat.id)
+    row = get_user_row(message.chat.id)
 
     try:
         file_info = bot.get_file(message.document.file_id)
         raw = bot.download_file(file_info.file_path)
     except Exception:
-        safe_send(message.chat.id, "Не получилось скачать файл. Попробуй ещё раз 🙂", reply_markup=menu_kb())
+        safe_send(message.chat.id, "Не получилось скачать файл. Попробуй ещё раз 🙂", reply_markup=MENU_KB)
         return
 
-    tmp_name = f"{message.from_user.id}_{int(time.time())}.xlsx"
-    with open(tmp_name, "wb") as f:
-        f.write(raw)
+    cache_key = file_cache_key(raw)
+    # тот же файл, что и в прошлый раз — нечего пересчитывать
+    if row["last_file_hash"] == cache_key:
+        safe_send(message.chat.id, "✅ Файл обработан.\n\nНовых оценок не обнаружено.", reply_markup=MENU_KB)
+        return
 
-    try:
-        items = parse_excel_grades(tmp_name)
-        rep = analyze_items(items)
-        if not rep:
-            safe_send(message.chat.id, "Не нашёл оценок в файле 😔", reply_markup=menu_kb())
+    items = _parse_cache.get(cache_key)
+    if items is not None:
+        _parse_cache.move_to_end(cache_key)
+    else:
+        try:
+            items = PARSE_POOL.submit(parse_excel_bytes, raw).result(timeout=60)
+        except FuturesTimeoutError:
+            safe_send(message.chat.id, "Файл обрабатывается слишком долго 😔 Попробуй ещё раз.", reply_markup=MENU_KB)
             return
+        _parse_cache[cache_key] = items
+        while len(_parse_cache) > PARSE_CACHE_LIMIT:
+            _parse_cache.popitem(last=False)
 
-        old_counter = get_counter(message.chat.id)
-        new_counter = make_counter(items)
-        added = diff_new_grades(old_counter, new_counter)
+    rep, new_counter = analyze_and_count(items)
+    if not rep:
+        safe_send(message.chat.id, "Не нашёл оценок в файле 😔", reply_markup=MENU_KB)
+        return
+
+    old_counter = get_counter(message.chat.id)
+    added = diff_new_grades(old_counter, new_counter)
 
-        # сохранить текущее состояние
-        set_counter(message.chat.id, new_counter)
+    # сохранить текущее состояние + snapshot для undo — одной транзакцией
+    _subjects_cache.pop(message.chat.id, None)
+    invalidate_history_cache(message.chat.id)
+    stamp = time.strftime("%Y-%m-%d %H:%M")
+    avg_json = json_dumps(rep["averages"])
+    with write_transaction():
+        set_counter(message.chat.id, new_counter, old=old_counter)
         set_user_fields(
             message.chat.id,
             last_overall=float(rep["overall"]),
-            last_averages_json=json.dumps(rep["averages"], ensure_ascii=False),
+            last_averages_json=avg_json,
+            last_file_hash=cache_key,
+            last_best=rep["best"],
+            last_worst=rep["worst"],
         )
-
-        # snapshot + counter snapshot (для undo)
-        stamp = time.strftime("%Y-%m-%d %H:%M")
-        snapshot_id = add_snapshot(message.chat.id, stamp, rep["overall"], rep["averages"])
+        snapshot_id = add_snapshot(message.chat.id, stamp, rep["overall"], avg_json)
         save_counter_snapshot(snapshot_id, new_counter)
-
-        msg = "✅ Файл обработан.\n"
-        if added:
-            msg += "\n🔔 Найдены новые оценки:\n"
-            lines = []
-            for subj, grade, cnt in added[:30]:
-                suffix = f" x{cnt}" if cnt > 1 else ""
-                lines.append(f"• {subj}: {grade}{suffix}")
-            msg += "\n".join(lines)
-            if len(added) > 30:
-                msg += f"\n…и ещё {len(added) - 30}"
-        else:
-            msg += "\nНовых оценок не обнаружено."
-
-        safe_send(message.chat.id, msg, reply_markup=menu_kb())
-
-    finally:
-        try:
-            os.remove(tmp_name)
-        except Exception:
-            pass
+    # повторная инвалидация после COMMIT: пока транзакция была открыта,
+    # параллельный read мог закэшировать ещё старые строку/серии/предметы
+    with _user_cache_lock:
+        _user_cache.pop(message.chat.id, None)
+    _subjects_cache.pop(message.chat.id, None)
+    invalidate_history_cache(message.chat.id)
+
+    msg = "✅ Файл обработан.\n"
+    if added:
+        msg += "\n🔔 Найдены новые оценки:\n"
+        lines = []
+        for subj, grade, cnt in added:
+            suffix = f" x{cnt}" if cnt > 1 else ""
+            lines.append(f"• {subj}: {grade}{suffix}")
+        msg += "\n".join(lines)
+    else:
+        msg += "\nНовых оценок не обнаружено."
+
+    # клавиатура — только на последнем куске
+    parts = chunk_text(msg)
+    for part in parts[:-1]:
+        safe_send(message.chat.id, part)
+    safe_send(message.chat.id, parts[-1], reply_markup=MENU_KB)
 
 # ================== Callback кнопок ==================
-@bot.callback_query_handler(func=lambda call: True)
-def on_callback(call):
-    chat_id = call.message.chat.id
-    ensure_user(chat_id)
-    row = get_user_row(chat_id)
-
-    if call.data == "summary":
-        overall = get_last_overall(chat_id)
-        averages = get_last_averages(chat_id)
-        if overall is None or not averages:
-            bot.answer_callback_query(call.id, "Сначала отправь Excel 🙂")
-            return
-        best = max(averages, key=averages.get)
-        worst = min(averages, key=averages.get)
-        safe_send(chat_id,
-                  f"📊 Средний балл: {overall:.2f}\n🏆 Лучший предмет: {best}\n⚠ Самый слабый предмет: {worst}",
-                  reply_markup=menu_kb())
-        bot.answer_callback_query(call.id)
+def cb_summary(call, chat_id, row):
+    overall = row["last_overall"]
+    averages = averages_from_row(row)
+    if overall is None or not averages:
+        bot.answer_callback_query(call.id, "Сначала отправь Excel 🙂")
         return
-
-    if call.data == "details":
-        averages = get_last_averages(chat_id)
-        if not averages:
-            bot.answer_callback_query(call.id, "Сначала отправь Excel 🙂")
-            return
-        lines = ["📚 Отчёт по предметам:"]
-        for subj, avg in sorted(averages.items(), key=lambda x: x[0]):
-            lines.append(f"• {subj}: {avg:.2f}")
-        safe_send(chat_id, "\n".join(lines), reply_markup=menu_kb())
-        bot.answer_callback_query(call.id)
+    # best/worst посчитаны при загрузке файла; max/min — только для старых записей
+    best = row["last_best"] or max(averages, key=averages.get)
+    worst = row["last_worst"] or min(averages, key=averages.get)
+    bot.answer_callback_query(call.id)
+    safe_send(chat_id,
+              f"📊 Средний балл: {overall:.2f}\n🏆 Лучший предмет: {best}\n⚠ Самый слабый предмет: {worst}",
+              reply_markup=MENU_KB)
+
+def cb_details(call, chat_id, row):
+    averages = averages_from_row(row)
+    if not averages:
+        bot.answer_callback_query(call.id, "Сначала отправь Excel 🙂")
         return
+    lines = ["📚 Отчёт по предметам:"]
+    for subj in get_subjects_sorted(chat_id, averages):
+        lines.append(f"• {subj}: {averages[subj]:.2f}")
+    bot.answer_callback_query(call.id)
+    safe_send(chat_id, "\n".join(lines), reply_markup=MENU_KB)
 
-    if call.data == "refresh":
-        safe_send(chat_id, "🔄 Ок! Пришли новый Excel-файл (.xlsx).", reply_markup=menu_kb())
-        bot.answer_callback_query(call.id)
-        return
+def cb_refresh(call, chat_id, row):
+    bot.answer_callback_query(call.id)
+    safe_send(chat_id, "🔄 Ок! Пришли новый Excel-файл (.xlsx).", reply_markup=MENU_KB)
 
-    if call.data == "trend":
-        hist = get_history(chat_id, limit=10)
-        if len(hist) < 2:
-            bot.answer_callback_query(call.id, "Нужно минимум 2 выгрузки Excel 🙂")
-            return
+def cb_trend(call, chat_id, row):
+    hist = get_history_overall(chat_id, limit=10)
+    if len(hist) < 2:
+        bot.answer_callback_query(call.id, "Нужно минимум 2 выгрузки Excel 🙂")
+        return
 
-        lines = ["📈 Динамика среднего балла (последние 10):"]
-        for h in hist:
-            lines.append(f"• {h['ts']}: {h['overall']:.2f}")
+    lines = ["📈 Динамика среднего балла (последние 10):"]
+    for ts, overall in hist:
+        lines.append(f"• {ts}: {overall:.2f}")
 
-        delta = hist[-1]["overall"] - hist[-2]["overall"]
-        if delta > 0:
-            lines.append(f"\n✅ Стало лучше на +{delta:.2f}")
-        elif delta < 0:
-            lines.append(f"\n⚠️ Стало хуже на {delta:.2f}")
-        else:
-            lines.append("\n➖ Без изменений")
+    delta = hist[-1][1] - hist[-2][1]
+    if delta > 0:
+        lines.append(f"\n✅ Стало лучше на +{delta:.2f}")
+    elif delta < 0:
+        lines.append(f"\n⚠️ Стало хуже на {delta:.2f}")
+    else:
+        lines.append("\n➖ Без изменений")
 
-        averages = get_last_averages(chat_id)
-        if averages:
-            lines.append("\nВыбери предмет для динамики 👇")
-            safe_send(chat_id, "\n".join(lines), reply_markup=subjects_kb(list(averages.keys()), page=0))
-        else:
-            safe_send(chat_id, "\n".join(lines), reply_markup=menu_kb())
+    averages = averages_from_row(row)
+    bot.answer_callback_query(call.id)
+    if averages:
+        lines.append("\nВыбери предмет для динамики 👇")
+        safe_send(chat_id, "\n".join(lines), reply_markup=subjects_kb(get_subjects_sorted(chat_id, averages), page=0))
+    else:
+        safe_send(chat_id, "\n".join(lines), reply_markup=MENU_KB)
+
+def cb_subjpage(call, chat_id, row, arg):
+    averages = averages_from_row(row)
+    if not averages:
+        bot.answer_callback_query(call.id, "Нет данных. Сначала отправь Excel 🙂")
+        return
+    page = int(arg)
+    bot.answer_callback_query(call.id)
+    safe_send(chat_id, "Выбери предмет:", reply_markup=subjects_kb(get_subjects_sorted(chat_id, averages), page=page))
 
-        bot.answer_callback_query(call.id)
+def cb_subj(call, chat_id, row, subject):
+    if len(get_history_overall(chat_id, limit=2)) < 2:
+        bot.answer_callback_query(call.id, "Нужно минимум 2 выгрузки Excel 🙂")
         return
 
-    if call.data.startswith("subjpage:"):
-        averages = get_last_averages(chat_id)
-        if not averages:
-            bot.answer_callback_query(call.id, "Нет данных. Сначала отправь Excel 🙂")
-            return
-        page = int(call.data.split(":", 1)[1])
-        safe_send(chat_id, "Выбери предмет:", reply_markup=subjects_kb(list(averages.keys()), page=page))
+    points = get_history_subject(chat_id, subject, limit=10)
+    if len(points) < 2:
         bot.answer_callback_query(call.id)
+        safe_send(chat_id, f"По предмету «{subject}» мало данных (нужно 2 выгрузки).", reply_markup=MENU_KB)
         return
 
-    if call.data.startswith("subj:"):
-        subject = call.data.split(":", 1)[1]
-        hist = get_history(chat_id, limit=10)
-        if len(hist) < 2:
-            bot.answer_callback_query(call.id, "Нужно минимум 2 выгрузки Excel 🙂")
-            return
+    lines = [f"📘 Динамика по предмету: {subject} (последние 10)"]
+    for ts, av in points:
+        lines.append(f"• {ts}: {av:.2f}")
 
-        points = []
-        for h in hist:
-            av = h.get("averages", {}).get(subject)
-            if av is not None:
-                points.append((h["ts"], float(av)))
+    delta = points[-1][1] - points[-2][1]
+    if delta > 0:
+        lines.append(f"\n✅ Улучшение: +{delta:.2f}")
+    elif delta < 0:
+        lines.append(f"\n⚠️ Ухудшение: {delta:.2f}")
+    else:
+        lines.append("\n➖ Без изменений")
 
-        if len(points) < 2:
-            safe_send(chat_id, f"По предмету «{subject}» мало данных (нужно 2 выгрузки).", reply_markup=menu_kb())
-            bot.answer_callback_query(call.id)
-            return
+    bot.answer_callback_query(call.id)
+    safe_send(chat_id, "\n".join(lines), reply_markup=MENU_KB)
 
-        lines = [f"📘 Динамика по предмету: {subject} (последние 10)"]
-        for ts, av in points:
-            lines.append(f"• {ts}: {av:.2f}")
+def cb_undo(call, chat_id, row):
+    last_id = get_latest_snapshot_id(chat_id)
+    if not last_id:
+        bot.answer_callback_query(call.id, "Нечего отменять 🙂")
+        return
 
-        delta = points[-1][1] - points[-2][1]
-        if delta > 0:
-            lines.append(f"\n✅ Улучшение: +{delta:.2f}")
-        elif delta < 0:
-            lines.append(f"\n⚠️ Ухудшение: {delta:.2f}")
-        else:
-            lines.append("\n➖ Без изменений")
+    _subjects_cache.pop(chat_id, None)
+    invalidate_history_cache(chat_id)
 
-        safe_send(chat_id, "\n".join(lines), reply_markup=menu_kb())
+    with db_lock:
+        cur = CON.cursor()
+        cur.execute("DELETE FROM snapshots WHERE id=?", (last_id,))
+        db_commit()
+
+    prev_id = get_latest_snapshot_id(chat_id)
+    if not prev_id:
+        set_user_fields(chat_id, last_overall=None, last_averages_json=None,
+                        last_file_hash=None, last_best=None, last_worst=None)
+        set_counter(chat_id, Counter())
+        # ещё раз после записей: конкурентный tap мог успеть закэшировать
+        # состояние между инвалидацией сверху и этими коммитами
+        _subjects_cache.pop(chat_id, None)
+        invalidate_history_cache(chat_id)
         bot.answer_callback_query(call.id)
+        safe_send(chat_id, "↩️ Откатил. История пуста, данные очищены.", reply_markup=MENU_KB)
         return
 
-    if call.data == "undo":
-        last_id = get_latest_snapshot_id(chat_id)
-        if not last_id:
-            bot.answer_callback_query(call.id, "Нечего отменять 🙂")
-            return
+    snap = get_snapshot_data(prev_id)
+    prev_counter = get_counter_by_snapshot(prev_id)
+    if not snap:
+        bot.answer_callback_query(call.id, "Не смог восстановить данные 😕")
+        return
 
-        with db_lock:
-            cur = CON.cursor()
-            cur.execute("DELETE FROM snapshots WHERE id=?", (last_id,))
-            CON.commit()
-
-        prev_id = get_latest_snapshot_id(chat_id)
-        if not prev_id:
-            set_user_fields(chat_id, last_overall=None, last_averages_json=None)
-            set_counter(chat_id, Counter())
-            safe_send(chat_id, "↩️ Откатил. История пуста, данные очищены.", reply_markup=menu_kb())
-            bot.answer_callback_query(call.id)
-            return
+    set_user_fields(
+        chat_id,
+        last_overall=float(snap["overall"]),
+        last_averages_json=json_dumps(snap["averages"]),
+        # иначе повторная загрузка отменённого файла была бы проигнорирована
+        last_file_hash=None,
+        last_best=max(snap["averages"], key=snap["averages"].get),
+        last_worst=min(snap["averages"], key=snap["averages"].get),
+    )
+    set_counter(chat_id, prev_counter)
+    _subjects_cache.pop(chat_id, None)
+    invalidate_history_cache(chat_id)
+    bot.answer_callback_query(call.id)
+    safe_send(chat_id, f"↩️ Откатил к выгрузке {snap['ts']}.", reply_markup=MENU_KB)
+
+def cb_reminders(call, chat_id, row):
+    enabled = bool(row["reminder_enabled"])
+    t = row["reminder_time"] or "не задано"
+    text = (
+        "⏰ Напоминания\n"
+        f"Статус: {'включены ✅' if enabled else 'выключены ⛔'}\n"
+        f"Время: {t}\n\n"
+        "Выбери время кнопками или введи своё."
+    )
+    bot.answer_callback_query(call.id)
+    safe_send(chat_id, text, reply_markup=REM_KB_ON if enabled else REM_KB_OFF)
 
-        snap = get_snapshot_data(prev_id)
-        prev_counter = get_counter_by_snapshot(prev_id)
-        if not snap:
-            bot.answer_callback_query(call.id, "Не смог восстановить данные 😕")
-            return
+def cb_rem_toggle(call, chat_id, row):
+    enabled = not bool(row["reminder_enabled"])
+    set_user_fields(chat_id, reminder_enabled=1 if enabled else 0)
 
-        set_user_fields(
-            chat_id,
-            last_overall=float(snap["overall"]),
-            last_averages_json=json.dumps(snap["averages"], ensure_ascii=False)
-        )
-        set_counter(chat_id, prev_counter)
-        safe_send(chat_id, f"↩️ Откатил к выгрузке {snap['ts']}.", reply_markup=menu_kb())
+    if not enabled:
+        unschedule_user_reminder(chat_id)
         bot.answer_callback_query(call.id)
+        safe_send(chat_id, "⛔ Напоминания выключены.", reply_markup=REM_KB_OFF)
         return
 
-    if call.data == "reminders":
-        enabled = bool(row["reminder_enabled"])
-        t = row["reminder_time"] or "не задано"
-        text = (
-            "⏰ Напоминания\n"
-            f"Статус: {'включены ✅' if enabled else 'выключены ⛔'}\n"
-            f"Время: {t}\n\n"
-            "Выбери время кнопками или введи своё."
-        )
-        safe_send(chat_id, text, reply_markup=reminders_kb(enabled))
+    if not row["reminder_time"]:
         bot.answer_callback_query(call.id)
+        safe_send(chat_id, "✅ Включил! Теперь выбери время 👇", reply_markup=REM_KB_ON)
         return
 
-    if call.data == "rem_toggle":
-        enabled = not bool(row["reminder_enabled"])
-        set_user_fields(chat_id, reminder_enabled=1 if enabled else 0)
+    schedule_user_reminder(chat_id, row["reminder_time"])
+    bot.answer_callback_query(call.id)
+    safe_send(chat_id, f"✅ Напоминания включены ({row['reminder_time']}).", reply_markup=REM_KB_ON)
 
-        if not enabled:
-            unschedule_user_reminder(chat_id)
-            safe_send(chat_id, "⛔ Напоминания выключены.", reply_markup=reminders_kb(False))
-            bot.answer_callback_query(call.id)
-            return
+def cb_time_custom(call, chat_id, row):
+    # повторный тап не должен копить хэндлеры: telebot вызывает ВСЕ
+    # зарегистрированные на чат, и следующий месседж обработался бы дважды
+    bot.clear_step_handler_by_chat_id(chat_id)
+    bot.register_next_step_handler_by_chat_id(chat_id, handle_time_input)
+    bot.answer_callback_query(call.id)
+    safe_send(chat_id, "Напиши время в формате HH:MM (например 18:30).")
 
-        row2 = get_user_row(chat_id)
-        if not row2["reminder_time"]:
-            safe_send(chat_id, "✅ Включил! Теперь выбери время 👇", reply_markup=reminders_kb(True))
-            bot.answer_callback_query(call.id)
-            return
+def cb_time_set(call, chat_id, row, hhmm):
+    set_user_fields(chat_id, reminder_time=hhmm)
+    if row["reminder_enabled"]:
+        schedule_user_reminder(chat_id, hhmm)
+    bot.answer_callback_query(call.id)
+    safe_send(chat_id, f"✅ Время установлено: {hhmm}", reply_markup=REM_KB_ON if row["reminder_enabled"] else REM_KB_OFF)
 
-        schedule_user_reminder(chat_id, row2["reminder_time"])
-        safe_send(chat_id, f"✅ Напоминания включены ({row2['reminder_time']}).", reply_markup=reminders_kb(True))
-        bot.answer_callback_query(call.id)
-        return
+def cb_back(call, chat_id, row):
+    bot.answer_callback_query(call.id)
+    safe_send(chat_id, "💬Меню:", reply_markup=MENU_KB)
+
+# O(1)-диспетчеризация вместо цепочки if/elif; точные значения — в словаре,
+# параметризованные callback_data — по префиксу.
+CALLBACKS = {
+    "summary": cb_summary,
+    "details": cb_details,
+    "refresh": cb_refresh,
+    "trend": cb_trend,
+    "undo": cb_undo,
+    "reminders": cb_reminders,
+    "rem_toggle": cb_rem_toggle,
+    "time_custom": cb_time_custom,
+    "back": cb_back,
+}
+
+PREFIX_CALLBACKS = (
+    ("subjpage:", cb_subjpage),
+    ("subj:", cb_subj),
+    ("time_", cb_time_set),
+)
 
-    if call.data.startswith("time_"):
-        hhmm = call.data.replace("time_", "")
-        set_user_fields(chat_id, reminder_time=hhmm)
-        row2 = get_user_row(chat_id)
-        if row2["reminder_enabled"]:
-            schedule_user_reminder(chat_id, hhmm)
-        safe_send(chat_id, f"✅ Время установлено: {hhmm}", reply_markup=reminders_kb(bool(row2["reminder_enabled"])))
-        bot.answer_callback_query(call.id)
-        return
+@bot.callback_query_handler(func=lambda call: True)
+def on_callback(call):
+    chat_id = call.message.chat.id
+    ensure_user(chat_id)
+    row = get_user_row(chat_id)
 
-    if call.data == "time_custom":
-        set_user_fields(chat_id, awaiting_time=1)
-        safe_send(chat_id, "Напиши время в формате HH:MM (например 18:30).")
-        bot.answer_callback_query(call.id)
+    handler = CALLBACKS.get(call.data)
+    if handler:
+        handler(call, chat_id, row)
         return
 
-    if call.data == "back":
-        safe_send(chat_id, "💬Меню:", reply_markup=menu_kb())
-        bot.answer_callback_query(call.id)
-        return
+    for prefix, prefix_handler in PREFIX_CALLBACKS:
+        if call.data.startswith(prefix):
+            prefix_handler(call, chat_id, row, call.data[len(prefix):])
+            return
 
     bot.answer_callback_query(call.id)
 
 # ================== Ввод своего времени ==================
-@bot.message_handler(content_types=["text"])
-def on_text(message):
+def handle_time_input(message):
     chat_id = message.chat.id
-    ensure_user(chat_id)
-    row = get_user_row(chat_id)
-
-    if row["awaiting_time"]:
-        raw = (message.text or "").strip()
-        try:
-            hh_s, mm_s = raw.split(":")
-            hh_i = int(hh_s)
-            mm_i = int(mm_s)
-            if not (0 <= hh_i <= 23 and 0 <= mm_i <= 59):
-                raise ValueError
-        except Exception:
-            set_user_fields(chat_id, awaiting_time=0)
-            safe_send(chat_id, "❌ Неправильный формат. Пример: 18:30")
-            return
 
-        hhmm = f"{hh_i:02d}:{mm_i:02d}"
-        set_user_fields(chat_id, awaiting_time=0, reminder_time=hhmm)
+    if message.content_type == "document":
+        # передумал и прислал файл — обрабатываем как обычную загрузку
+        on_document(message)
+        return
 
-        row2 = get_user_row(chat_id)
-        if row2["reminder_enabled"]:
-            schedule_user_reminder(chat_id, hhmm)
+    raw = (message.text or "").strip()
+    if raw.startswith("/"):
+        # команда важнее сценария ввода времени — возвращаем её в обычную
+        # диспетчеризацию, а не съедаем как «неправильный формат»
+        bot.process_new_messages([message])
+        return
 
-        safe_send(chat_id, f"✅ Время установлено: {hhmm}", reply_markup=menu_kb())
+    m = TIME_RE.match(raw)
+    if not m:
+        safe_send(chat_id, "❌ Неправильный формат. Пример: 18:30")
         return
 
-    safe_send(chat_id, "Выбери действие кнопками 👇", reply_markup=menu_kb())
+    hhmm = f"{int(m[1]):02d}:{int(m[2]):02d}"
+    set_user_fields(chat_id, reminder_time=hhmm)
+
+    row = get_user_row(chat_id)
+    if row["reminder_enabled"]:
+        schedule_user_reminder(chat_id, hhmm)
+
+    safe_send(chat_id, f"✅ Время установлено: {hhmm}", reply_markup=MENU_KB)
+
+@bot.message_handler(content_types=["text"])
+def on_text(message):
+    # обычный текст вне сценария ввода времени — просто показываем меню,
+    # без чтения/записи состояния
+    safe_send(message.chat.id, "Выбери действие кнопками 👇", reply_markup=MENU_KB)
 
 # ================== авто-перезапуск polling ==================
 def run_polling_forever():
+    print("Telegram bot started")
     while True:
         try:
-            # skip_pending=True — чтобы после перезапуска не разгребать старые апдейты
-            bot.infinity_polling(timeout=20, long_polling_timeout=20, skip_pending=True)
+            # skip_pending=True — чтобы после перезапуска не разгребать старые апдейты;
+            # allowed_updates — Telegram не шлёт типы апдейтов, которые мы не обрабатываем
+            bot.infinity_polling(timeout=20, long_polling_timeout=20, skip_pending=True,
+                                 allowed_updates=["message", "callback_query"])
         except Exception as e:
             # Если polling упал — подождать и подняться снова
             print(f"[polling] crashed: {e}")
             time.sleep(5)
 
-def run_bot():
-    print("Telegram bot started")
-    bot.infinity_polling()
+def main():
+    # всё потоковое/сетевое — только здесь: импорт модуля остаётся чистым
+    threading.Thread(target=_send_worker, daemon=True).start()
+    scheduler.start()
+    restore_jobs_from_db()
 
-threading.Thread(target=run_bot, daemon=True).start()
+    if PUBLIC_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=f"{PUBLIC_URL.rstrip('/')}/{BOT_TOKEN}",
+                        allowed_updates=["message", "callback_query"])
+        print("Webhook mode")
+    else:
+        bot.remove_webhook()
+        threading.Thread(target=run_polling_forever, daemon=True).start()
 
-print("Flask started")
+    print("Flask started")
 
-port = int(os.environ.get("PORT", 10000))
-app.run(host="0.0.0.0", port=port)
\ No newline at end of file
+    port = int(os.environ.get("PORT", 10000))
+    try:
+        # werkzeug-овский dev-сервер однопоточный; waitress тянет webhook и healthcheck параллельно
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=port, threads=4)
+    except ImportError:
+        app.run(host="0.0.0.0", port=port)
+
+if __name__ == "__main__":
+    main()